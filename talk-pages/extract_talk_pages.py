@@ -4,6 +4,9 @@ import sys
 
 import xml.etree.ElementTree as ET
 
+import metrics
+import pagestore
+
 
 PAGE_START = r'<page>'
 PAGE_END = r'</page>'
@@ -12,6 +15,8 @@ def parse_args():
 	opts = argparse.ArgumentParser(description='Extract Talk pages from Wikipedia dumps')
 	opts.add_argument('dumpfile')
 	opts.add_argument('--talk', default='Talk', help='The local form of "Talk" used')
+	opts.add_argument('--output', help='Write to this file instead of stdout; a .bz2 file is written as seekable multistream bz2 with an index')
+	metrics.add_args(opts)
 	args = opts.parse_args()
 	return args
 
@@ -23,9 +28,11 @@ def pages(dumpfile):
 	in_page = False
 
 	for line in stream:
+		metrics.count('bytes_decompressed', len(line))
 		line = line.decode('utf8')
 		if PAGE_END in line:
 			current_page += line
+			metrics.count('pages_parsed')
 			yield current_page
 			current_page = ''
 			in_page = False
@@ -47,16 +54,30 @@ def is_talk_page(page, talk):
 		return False
 
 
+def talk_pages(dumpfile, talk):
+	for page in pages(dumpfile):
+		if is_talk_page(page, talk):
+			metrics.count('pages_kept')
+			yield page
+
+
 def main():
 	args = parse_args()
-
-	print('<pages>')
-	n_pages = 0
-	for page in pages(args.dumpfile):
-		if is_talk_page(page, args.talk):
-			print(page)
-			n_pages += 1
-	print('</pages>')
+	metrics.configure(args.metrics, args.profile)
+
+	with metrics.stage('extract'):
+		if args.output is not None and args.output.endswith('.bz2'):
+			n_pages = pagestore.write_frames(args.output, talk_pages(args.dumpfile, args.talk))
+		else:
+			out = sys.stdout if args.output is None else open(args.output, 'w')
+			print('<pages>', file=out)
+			n_pages = 0
+			for page in talk_pages(args.dumpfile, args.talk):
+				print(page, file=out)
+				n_pages += 1
+			print('</pages>', file=out)
+			if args.output is not None:
+				out.close()
 	print('{} talk pages found'.format(n_pages), file=sys.stderr)
 
 
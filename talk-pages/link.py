@@ -1,4 +1,5 @@
 import argparse
+import mmap
 import os.path
 import pandas as pd
 import sys
@@ -6,7 +7,9 @@ import sys
 from sqlalchemy import create_engine
 from sqlalchemy.sql import text
 from tqdm import tqdm
-from xml.etree import ElementTree as ET
+
+import metrics
+import pagestore
 
 
 MATCHES_TABLE = 'en_matches'
@@ -24,6 +27,7 @@ def parse_args():
     opts.add_argument('sql_file')
     opts.add_argument('talk_pages_file_base')
     opts.add_argument('--skip-mapping', action='store_true', help='Skip the SQL-based mapping step and simply extract files')
+    metrics.add_args(opts)
     args = opts.parse_args()
     return args
 
@@ -58,11 +62,32 @@ def get_mappings(matches_table, con):
     return mappings
 
 
+def matching_pages(pages_file, to_extract, title_element='title'):
+    """Yields the pages in `to_extract` from a Talk pages file, either plain XML or written by pagestore.write_frames.
+
+    Only each page's title and ID are read to decide whether it is wanted. For the latter
+    kind of file, only the frames holding a wanted page are decompressed.
+
+    Yields:
+        tuple: (key, page), where key is the page's title or ID, per `title_element`, and page
+            is the verbatim `<page>...</page>` bytes.
+    """
+    key = lambda page_id, title: page_id if title_element == 'id' else title
+    wanted = lambda page_id, title: key(page_id, title) in to_extract
+    if pagestore.is_framed(pages_file):
+        for page_id, title, page in pagestore.iter_pages(pages_file, wanted):
+            yield key(page_id, title), page
+    else:
+        with open(pages_file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            for page_id, title, page in pagestore.matching_pages(mapped, wanted):
+                yield key(page_id, title), page
+
+
 def extract_pages(pages_file, to_extract, title_element='title', save=True, save_location=None):
     """Extracts specified Talk pages from an XML file.
 
     Args:
-        pages_file (str): Path to the XML file containing Talk pages.
+        pages_file (str): Path to the XML file containing Talk pages, or a .bz2 file with an index written by extract_talk_pages.py.
         to_extract (dict): A dictionary of {prefix:title -> en_page_id} where prefix is the Talk prefix used in this language.
         save (bool): Whether to save the extracted pages.
         save_location (str, optional): File in which to save output. If None (by default), saves to the same directory as the XML file.
@@ -72,30 +97,27 @@ def extract_pages(pages_file, to_extract, title_element='title', save=True, save
     """
     if save_location is None:
         save_location = os.path.join(os.path.split(pages_file)[0], 'matched_{}'.format(pages_file))
+        if pagestore.is_framed(pages_file):  # the matched pages are written uncompressed
+            save_location = os.path.splitext(save_location)[0]
 
     num_to_extract = len(to_extract)
     extracted = set()
 
     with tqdm(desc='Extracting {} pages from {}'.format(num_to_extract, pages_file), total=num_to_extract) as prog_bar:
-        with open(save_location, 'w') as out:
+        with open(save_location, 'wb') as out:
             if save:
-                print('<pages>', file=out)
-            for _, elem in ET.iterparse(pages_file):
-                if elem.tag == 'page':
-                    title = elem.find(title_element).text
-                    if title in to_extract:
-                        en_page_id = to_extract[title]
-                        extracted.add(en_page_id)
-                        prog_bar.update(1)
-                        if save:
-                            dlatk_id = ET.Element('dlatk_id')
-                            dlatk_id.text = str(en_page_id)
-                            elem.append(dlatk_id)
-                            page_xml = ET.tostring(elem, encoding='unicode')
-                            print(page_xml, file=out)
-                    elem.clear()
+                out.write(b'<pages>\n')
+            for title, page in matching_pages(pages_file, to_extract, title_element):
+                en_page_id = to_extract[title]
+                extracted.add(en_page_id)
+                metrics.count('pages_kept')
+                prog_bar.update(1)
+                if save:
+                    # Copy the page as is, adding the dlatk_id as its last element
+                    dlatk_id = '<dlatk_id>{}</dlatk_id>'.format(en_page_id).encode('utf8')
+                    out.write(page[:-len(pagestore.PAGE_END)] + dlatk_id + pagestore.PAGE_END + b'\n')
             if save:
-                print('</pages>', file=out)
+                out.write(b'</pages>\n')
     return extracted
 
 
@@ -138,18 +160,22 @@ def get_english_ids(main_article_ids, db_con):
 
 def main():
     args = parse_args()
+    metrics.configure(args.metrics, args.profile)
     con = db_connect(args.db)
 
     if not args.skip_mapping:
         print('Matching pages...', file=sys.stderr)
-        execute_sql_file(args.sql_file, con)
+        with metrics.stage('match_sql'):
+            execute_sql_file(args.sql_file, con)
     
     print('Getting mappings...', file=sys.stderr)
-    mappings = get_mappings(MATCHES_TABLE, con)
+    with metrics.stage('read_mappings'):
+        mappings = get_mappings(MATCHES_TABLE, con)
     
     # First pass so we can identify the common pages
     print('First pass; not all pages will be extracted', file=sys.stderr)
-    extracted = extract_all_langs(mappings, args.talk_pages_file_base, save=False)
+    with metrics.stage('first_pass'):
+        extracted = extract_all_langs(mappings, args.talk_pages_file_base, save=False)
 
     # Second pass, the one we actually want
     print('Second pass; all pages should be extracted', file=sys.stderr)
@@ -158,17 +184,19 @@ def main():
     # Start with English: first get_english_ids will only get ids for main articles with talk pages
     # and since universal_mappings only includes pages that exist in all other languages, if they
     # have a page in English, they have a page in all languages
-    universal_mappings['en'] = get_english_ids(universal_mappings.index.to_numpy(), con)
+    with metrics.stage('english_ids'):
+        universal_mappings['en'] = get_english_ids(universal_mappings.index.to_numpy(), con)
 
     # Drop any that don't have a talk page in English; all other languages are already filtered
     universal_mappings = universal_mappings.dropna()
 
     # Finally, extract and save the English talk pages
-    pages, pages_file = process_mappings(universal_mappings, 'en', args.talk_pages_file_base)
-    extract_pages(pages_file, pages, title_element='id', save=True)
+    with metrics.stage('second_pass'):
+        pages, pages_file = process_mappings(universal_mappings, 'en', args.talk_pages_file_base)
+        extract_pages(pages_file, pages, title_element='id', save=True)
 
-    # And then do the same for all other languages
-    extract_all_langs(universal_mappings, args.talk_pages_file_base)
+        # And then do the same for all other languages
+        extract_all_langs(universal_mappings, args.talk_pages_file_base)
 
 
 if __name__ == '__main__':
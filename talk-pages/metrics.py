@@ -0,0 +1,193 @@
+"""Lightweight per-stage instrumentation shared by the pipeline scripts.
+
+Scripts call `add_args` on their parser and `configure` at the start of `main`.
+Work is wrapped in `stage` blocks and hot paths bump named counters with `count`.
+When a stage ends, one JSON line with its wall time, counter deltas, throughput
+and peak RSS is appended to the metrics file. With no metrics file configured,
+`count` returns immediately and `stage` only yields, so the overhead is negligible.
+
+On Linux, peak RSS is the stage's own: the kernel's high-water mark is reset when
+a stage starts and read when it ends. Elsewhere only the peak since the process
+started is available, and it is reported as `peak_rss_cumulative_mb` instead.
+
+Counters are per process: anything counted inside worker processes is
+not seen by the parent, so count results in the parent where possible.
+"""
+import atexit
+import json
+import os
+import resource
+import sys
+import time
+from contextlib import contextmanager
+
+
+_enabled = False
+_out = None
+_profiler = None
+_profile_file = None
+_counters = {}
+_stage_peaks = []  # peak RSS so far of each open stage, innermost last
+_run_peak = None  # resetting the high-water mark also resets ru_maxrss, so keep the run's peak here
+_script = os.path.basename(sys.argv[0])
+
+
+def add_args(opts):
+    opts.add_argument('--metrics', help='Append per-stage timings, counters and peak memory as JSON lines to this file')
+    opts.add_argument('--profile', help='Write a profile of the run to this file; .html uses pyinstrument, anything else cProfile')
+
+
+def configure(metrics_file=None, profile_file=None):
+    """Turns instrumentation on for this process.
+
+    Args:
+        metrics_file (str, optional): JSON-lines file to append stage records to. If None, metrics stay off.
+        profile_file (str, optional): File to dump a cProfile (or pyinstrument, for .html) profile to at exit.
+    """
+    global _enabled, _out, _profiler, _profile_file
+    if metrics_file is not None:
+        _out = open(metrics_file, 'a')
+        _enabled = True
+    if profile_file is not None:
+        _profile_file = profile_file
+        if profile_file.endswith('.html'):
+            from pyinstrument import Profiler
+            _profiler = Profiler()
+            _profiler.start()
+        else:
+            import cProfile
+            _profiler = cProfile.Profile()
+            _profiler.enable()
+    atexit.register(close)
+
+
+def count(name, n=1):
+    """Adds `n` to the named counter.
+
+    Counters named `[x]_seconds` are durations: they are left out of `per_second`, and if
+    there is also an `[x]_requests` counter, the mean latency `[x]_seconds / [x]_requests`
+    is reported under `mean_seconds`.
+    """
+    if not _enabled:
+        return
+    _counters[name] = _counters.get(name, 0) + n
+
+
+def _cumulative_peak_rss_mb():
+    # ru_maxrss is in KB on Linux and bytes on macOS
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale
+    return {'peak_rss_cumulative_mb': round(own, 1), 'peak_rss_children_cumulative_mb': round(children, 1)}
+
+
+def _high_water_mark_mb():
+    """The kernel's RSS high-water mark (VmHWM) in MB, or None where /proc is not available."""
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def _reset_high_water_mark():
+    """Resets VmHWM to the current RSS. Returns False if the kernel does not support it."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _start_peak():
+    # Fold the peak so far into the enclosing stage before resetting, so it is not lost
+    if _stage_peaks and _stage_peaks[-1] is not None:
+        _stage_peaks[-1] = max(_stage_peaks[-1], _high_water_mark_mb())
+    _stage_peaks.append(0 if _reset_high_water_mark() else None)
+
+
+def _end_peak():
+    global _run_peak
+    peak = _stage_peaks.pop()
+    if peak is None:
+        return _cumulative_peak_rss_mb()
+    peak = max(peak, _high_water_mark_mb())
+    if _stage_peaks and _stage_peaks[-1] is not None:
+        _stage_peaks[-1] = max(_stage_peaks[-1], peak)
+    _run_peak = peak if _run_peak is None else max(_run_peak, peak)
+    return {'peak_rss_mb': round(peak, 1)}
+
+
+def _rates(counters, seconds):
+    """Throughput of the count counters and mean latency of the duration counters."""
+    per_second = {k: round(v / seconds, 1) for k, v in counters.items() if not k.endswith('_seconds')} if seconds > 0 else {}
+    mean_seconds = {}
+    for k, v in counters.items():
+        if k.endswith('_seconds'):
+            name = k[:-len('_seconds')]
+            requests = counters.get(name + '_requests')
+            if requests:
+                mean_seconds[name] = round(v / requests, 3)
+    return {'per_second': per_second, 'mean_seconds': mean_seconds}
+
+
+def _write(record):
+    record['script'] = _script
+    record['pid'] = os.getpid()
+    record['time'] = time.time()
+    print(json.dumps(record), file=_out, flush=True)
+
+
+@contextmanager
+def stage(name):
+    """Times the enclosed block and records the counters it bumped.
+
+    Args:
+        name (str): Name of the stage, e.g. 'parse' or 'write_db'.
+    """
+    if not _enabled:
+        yield
+        return
+
+    before = dict(_counters)
+    _start_peak()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        counters = {k: v - before.get(k, 0) for k, v in _counters.items() if v != before.get(k, 0)}
+        record = {
+            'stage': name,
+            'seconds': round(seconds, 3),
+            'counters': counters,
+        }
+        record.update(_rates(counters, seconds))
+        record.update(_end_peak())
+        _write(record)
+
+
+def close():
+    """Writes the run totals and the profile dump, if either is enabled. Safe to call more than once."""
+    global _enabled, _profiler
+    if _profiler is not None:
+        if _profile_file.endswith('.html'):
+            _profiler.stop()
+            with open(_profile_file, 'w') as f:
+                f.write(_profiler.output_html())
+        else:
+            _profiler.disable()
+            _profiler.dump_stats(_profile_file)
+        _profiler = None
+    if _enabled:
+        record = {'stage': 'total', 'counters': dict(_counters), 'mean_seconds': _rates(_counters, 0)['mean_seconds']}
+        record.update(_cumulative_peak_rss_mb())
+        if _run_peak is not None:
+            record['peak_rss_cumulative_mb'] = round(max(_run_peak, _high_water_mark_mb()), 1)
+        _write(record)
+        _out.close()
+        _enabled = False
@@ -3,15 +3,19 @@ import csv
 import mwparserfromhell
 import sys
 
-from joblib import Parallel, delayed
-from tqdm import tqdm
 from xml.etree import ElementTree as ET
 
+import metrics
+import shard
+from parallel import parallel_map
+
 
 def parse_args():
 	opts = argparse.ArgumentParser()
 	opts.add_argument('xml_file', help='Output of link.py')
 	opts.add_argument('language')
+	metrics.add_args(opts)
+	shard.add_args(opts)
 	args = opts.parse_args()
 	return args
 
@@ -33,19 +37,36 @@ def get_values(page):
 	return dlatk_id, wiki_id, title, content
 
 
-def pages(pages_file, lang):
+def page_length(page):
+	return len(page.find('revision').find('text').text or '')
+
+
+def pages(pages_file, lang, shard_index=0, num_shards=1):
 	csvout = csv.writer(sys.stdout)
-	root = ET.parse(pages_file)
-	pages = tqdm(root.findall('page'), desc=lang)
-	extracted_data = Parallel(n_jobs=10)(delayed(get_values)(page) for page in pages)
-	for page in extracted_data:
-		dlatk_id, wiki_id, title, content = page
-		csvout.writerow([dlatk_id, lang, wiki_id, title, content])
+	with metrics.stage('parse_xml'):
+		pages = []
+		for _, elem in ET.iterparse(pages_file):
+			if elem.tag != 'page':
+				continue
+			if shard.in_shard(elem.find('dlatk_id').text, shard_index, num_shards):
+				pages.append(elem)
+			else:
+				elem.clear()  # so other shards' page text is never held in memory
+		metrics.count('pages_parsed', len(pages))
+	with metrics.stage('cleanup_wikitext'):
+		extracted_data = parallel_map(get_values, pages, cost=page_length, n_jobs=10, desc=lang)
+	with metrics.stage('write_csv'):
+		for page in extracted_data:
+			dlatk_id, wiki_id, title, content = page
+			csvout.writerow([dlatk_id, lang, wiki_id, title, content])
+			metrics.count('rows_written')
 
 
 def main():
 	args = parse_args()
-	pages(args.xml_file, args.language)
+	metrics.configure(args.metrics, args.profile)
+	shard.check_shard(args.shard, args.num_shards)
+	pages(args.xml_file, args.language, args.shard, args.num_shards)
 
 
 if __name__ == '__main__':
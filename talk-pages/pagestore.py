@@ -0,0 +1,160 @@
+"""Seekable compressed storage for extracted Talk pages.
+
+Pages are written as multistream bz2, the same layout Wikipedia uses for its
+`pages-articles-multistream` dumps: every `PAGES_PER_FRAME` pages are compressed
+as an independent bz2 stream (a frame) that starts and ends on page boundaries.
+A text index next to the file, `[file].index`, has one `offset:page_id:title`
+line per page, where offset is the byte offset of the page's frame.
+
+The file as a whole is still a valid bz2 file of `<pages>...</pages>` XML, so
+`bzcat` and `bz2.open` read it as before, while `iter_pages` uses the index to
+decompress only the frames holding the pages asked for.
+
+`matching_pages` finds pages in raw XML bytes, plain or decompressed, by reading
+only each page's `<title>` and `<id>`; the rest of a page is never decoded or
+parsed, and wanted pages are returned as their verbatim source bytes.
+"""
+import bz2
+import html
+import os.path
+import re
+from itertools import groupby
+
+import metrics
+
+
+PAGES_PER_FRAME = 100
+
+# The header and trailer are frames of their own; compression is deterministic, so
+# the trailer's length tells us where the last page frame ends
+PAGES_HEADER = bz2.compress(b'<pages>\n')
+PAGES_TRAILER = bz2.compress(b'</pages>\n')
+
+PAGE_START = b'<page>'
+PAGE_END = b'</page>'
+TITLE_TAG_REGEX = re.compile(rb'<title>(.*?)</title>', re.DOTALL)
+ID_TAG_REGEX = re.compile(rb'<id>([0-9]+)</id>')
+
+
+def index_path(path):
+    return path + '.index'
+
+
+def is_framed(path):
+    """Whether `path` was written by `write_frames`, i.e. has an index next to it."""
+    return os.path.exists(index_path(path))
+
+
+def _page_id_and_title(buf, start, end):
+    page_id = ID_TAG_REGEX.search(buf, start, end).group(1).decode('utf8')
+    title = html.unescape(TITLE_TAG_REGEX.search(buf, start, end).group(1).decode('utf8'))
+    return page_id, title
+
+
+def _write_frame(out, index, frame):
+    offset = out.tell()
+    out.write(bz2.compress(b''.join(page for page, _, _ in frame)))
+    for _, page_id, title in frame:
+        print('{}:{}:{}'.format(offset, page_id, title), file=index)
+
+
+def write_frames(path, pages, pages_per_frame=PAGES_PER_FRAME):
+    """Writes pages to a multistream bz2 file with an index of where each page's frame starts.
+
+    Args:
+        path (str): File to write; the index is written to `index_path(path)`.
+        pages (iterable): Page XML strings, each a full `<page>...</page>` element.
+        pages_per_frame (int): Number of pages compressed together in each frame.
+
+    Returns:
+        int: The number of pages written.
+    """
+    n_pages = 0
+    with open(path, 'wb') as out, open(index_path(path), 'w') as index:
+        out.write(PAGES_HEADER)
+        frame = []
+        for page in pages:
+            page = page.encode('utf8')
+            page_id, title = _page_id_and_title(page, 0, len(page))
+            frame.append((page, page_id, title))
+            n_pages += 1
+            if len(frame) == pages_per_frame:
+                _write_frame(out, index, frame)
+                frame = []
+        if frame:
+            _write_frame(out, index, frame)
+        out.write(PAGES_TRAILER)
+    return n_pages
+
+
+def read_index(path):
+    """Reads the index of a file written by `write_frames`.
+
+    Returns:
+        list: (frame_offset, page_id, title) for every page, in file order.
+    """
+    entries = []
+    with open(index_path(path)) as index:
+        for line in index:
+            offset, page_id, title = line.rstrip('\n').split(':', 2)
+            entries.append((int(offset), page_id, title))
+    return entries
+
+
+def read_frame(f, offset, length):
+    """Reads and decompresses exactly the frame at `offset` of an open file.
+
+    Args:
+        f (file): File written by `write_frames`, opened in binary mode.
+        offset (int): Byte offset of the frame, from the index.
+        length (int): Compressed length of the frame in bytes.
+
+    Returns:
+        bytes: The XML of the pages in the frame.
+    """
+    f.seek(offset)
+    data = f.read(length)
+    metrics.count('bytes_read', len(data))
+    return bz2.decompress(data)
+
+
+def matching_pages(buf, wanted):
+    """Yields the wanted pages of raw page XML, looking only at each page's title and ID.
+
+    Args:
+        buf (bytes-like): XML holding `<page>` elements, e.g. a memory-mapped file or a decompressed frame.
+        wanted (callable): Called as `wanted(page_id, title)` for each page.
+
+    Yields:
+        tuple: (page_id, title, page) for each wanted page, where page is the verbatim
+            `<page>...</page>` bytes.
+    """
+    start = buf.find(PAGE_START)
+    while start != -1:
+        end = buf.find(PAGE_END, start) + len(PAGE_END)
+        page_id, title = _page_id_and_title(buf, start, end)
+        metrics.count('pages_parsed')
+        if wanted(page_id, title):
+            yield page_id, title, buf[start:end]
+        start = buf.find(PAGE_START, end)
+
+
+def iter_pages(path, wanted):
+    """Yields the wanted pages of a file written by `write_frames`, skipping frames without any.
+
+    Args:
+        path (str): File written by `write_frames`.
+        wanted (callable): Called as `wanted(page_id, title)` for each page in the index.
+
+    Yields:
+        tuple: (page_id, title, page) as in `matching_pages`.
+    """
+    frames = [(offset, list(entries)) for offset, entries in groupby(read_index(path), key=lambda entry: entry[0])]
+    # Each frame ends where the next one starts; the last one ends at the trailer
+    ends = [offset for offset, _ in frames[1:]] + [os.path.getsize(path) - len(PAGES_TRAILER)]
+    with open(path, 'rb') as f:
+        for (offset, entries), end in zip(frames, ends):
+            if not any(wanted(page_id, title) for _, page_id, title in entries):
+                continue
+            metrics.count('frames_read')
+            yield from matching_pages(read_frame(f, offset, end - offset), wanted)
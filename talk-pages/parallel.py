@@ -0,0 +1,94 @@
+"""Size-aware parallel map shared by the page processing scripts.
+
+Talk page sizes are very skewed, so handing workers equal-sized chunks in input
+order leaves one worker on a handful of huge pages at the end while the rest sit
+idle. `parallel_map` instead sorts items by estimated cost, packs small items into
+batches of roughly equal cost, and feeds the batches largest first to a pool
+whose workers pull the next batch as soon as they finish one. Results are
+returned in input order.
+"""
+from functools import partial
+from multiprocessing import Pool
+
+from tqdm import tqdm
+
+import metrics
+
+
+BATCHES_PER_WORKER = 8
+
+
+def _run_batch(func, batch):
+    return [(i, func(item)) for i, item in batch]
+
+
+def make_batches(items, costs, n_jobs, batches_per_worker=BATCHES_PER_WORKER):
+    """Groups items into batches of roughly equal cost, most expensive batch first.
+
+    Items at least as costly as the target batch cost get a batch to themselves;
+    smaller items are packed together until a batch reaches the target.
+
+    Args:
+        items (list): Items to process.
+        costs (list): Estimated cost of each item, e.g. its text length.
+        n_jobs (int): Number of workers the batches will be spread over.
+        batches_per_worker (int): Roughly how many batches each worker should get, so that
+            the tail of the schedule is made of small batches.
+
+    Returns:
+        list: Batches, each a list of (index, item) tuples.
+    """
+    order = sorted(range(len(items)), key=lambda i: costs[i], reverse=True)
+    target = max(sum(costs) / (n_jobs * batches_per_worker), 1)
+
+    batches = []
+    batch, batch_cost = [], 0
+    for i in order:
+        if costs[i] >= target:
+            batches.append([(i, items[i])])
+            continue
+        batch.append((i, items[i]))
+        batch_cost += costs[i]
+        if batch_cost >= target:
+            batches.append(batch)
+            batch, batch_cost = [], 0
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def parallel_map(func, items, cost=len, n_jobs=10, desc=None):
+    """Applies `func` to every item in parallel, scheduling the most expensive items first.
+
+    Args:
+        func (callable): Picklable function of one item, e.g. a module-level function or a partial.
+        items (iterable): Items to process.
+        cost (callable): Estimates the cost of an item; text length by default.
+        n_jobs (int): Number of worker processes. With 1, items are processed in this process.
+        desc (str, optional): Progress bar description.
+
+    Returns:
+        list: `func(item)` for each item, in input order.
+    """
+    items = list(items)
+    costs = [cost(item) for item in items]
+    batches = make_batches(items, costs, n_jobs)
+    metrics.count('parallel_batches', len(batches))
+
+    results = [None] * len(items)
+    pool = Pool(n_jobs) if n_jobs > 1 else None
+    try:
+        if pool is None:
+            done = map(partial(_run_batch, func), batches)
+        else:
+            # chunksize=1 so each worker pulls a new batch only when it has finished the last one
+            done = pool.imap_unordered(partial(_run_batch, func), batches, chunksize=1)
+        with tqdm(desc=desc, total=len(items)) as prog_bar:
+            for batch in done:
+                for i, result in batch:
+                    results[i] = result
+                prog_bar.update(len(batch))
+    finally:
+        if pool is not None:
+            pool.terminate()
+    return results
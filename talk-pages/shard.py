@@ -0,0 +1,190 @@
+"""Hash-partitioned sharding for page_text.py, turns.py and the translate scripts.
+
+Each script takes `--shard I --num-shards N` and only processes the pages whose key
+(`unified_id` or `message_wiki_id`) hashes to shard I, writing its own partition.
+Shards are independent processes, so they can run side by side on one machine or
+on different nodes. Once all N have finished, merge and validate the partitions:
+
+    python shard.py merge-tables [db] [table] [key column] --num-shards N
+    python shard.py merge-csvs [out.csv] [key column] [shard 0 csv] ... [shard N-1 csv] [--header]
+
+With the default `--num-shards 1` nothing is filtered and no names change.
+"""
+import argparse
+import csv
+import os.path
+import sys
+import zlib
+
+import pandas as pd
+from sqlalchemy import create_engine
+from sqlalchemy.sql import text
+
+
+def add_args(opts):
+    opts.add_argument('--shard', type=int, default=0, help='Index of the shard to process, from 0 to --num-shards - 1')
+    opts.add_argument('--num-shards', type=int, default=1, help='Number of shards the work is partitioned into')
+
+
+def parse_args():
+    opts = argparse.ArgumentParser(description='Merge and validate sharded outputs')
+    commands = opts.add_subparsers(dest='command', required=True)
+    tables = commands.add_parser('merge-tables', help='Merge partition tables written by each shard into one table')
+    tables.add_argument('db')
+    tables.add_argument('table', help='Name of the table without the shard suffix')
+    tables.add_argument('key', help='Column the shards were partitioned on')
+    tables.add_argument('--num-shards', type=int, required=True)
+    csvs = commands.add_parser('merge-csvs', help='Concatenate the CSV written by each shard, in shard order')
+    csvs.add_argument('out_file')
+    csvs.add_argument('key', help='Index of the column the shards were partitioned on, or its name with --header')
+    csvs.add_argument('shard_files', nargs='+', help='CSV written by each shard, in shard order')
+    csvs.add_argument('--header', action='store_true', help='Each CSV starts with a header row; the first is kept and the rest are checked and skipped')
+    args = opts.parse_args()
+    return args
+
+
+def db_connect(db):
+    con = create_engine(
+        'mysql://127.0.0.1/{}?read_default_file=~/.my.cnf&charset=utf8mb4'.format(db))
+    return con
+
+
+def shard_of(key, num_shards):
+    """Stable shard assignment for a page key.
+
+    Keys are compared as strings of integers where possible, so the same page maps to the same
+    shard whether its ID came from XML (str), pandas (int or float) or MySQL (int).
+    """
+    try:
+        key = str(int(float(key)))
+    except (TypeError, ValueError):
+        key = str(key)
+    return zlib.crc32(key.encode('utf8')) % num_shards
+
+
+def check_shard(shard, num_shards):
+    if not 0 <= shard < num_shards:
+        raise ValueError('--shard must be between 0 and {}, got {}'.format(num_shards - 1, shard))
+
+
+def in_shard(key, shard, num_shards):
+    return num_shards == 1 or shard_of(key, num_shards) == shard
+
+
+def select(df, key, shard, num_shards):
+    """Subsets a DataFrame to the rows whose `key` column hashes to this shard."""
+    if num_shards == 1:
+        return df
+    return df[df[key].map(lambda k: shard_of(k, num_shards) == shard)]
+
+
+def sql_condition(key, shard, num_shards):
+    """MySQL condition selecting the rows whose `key` column hashes to this shard.
+
+    MySQL's CRC32 reads an integer as its decimal string, so this matches `shard_of`.
+    """
+    if num_shards == 1:
+        return 'TRUE'
+    return 'MOD(CRC32({}), {}) = {}'.format(key, num_shards, shard)
+
+
+def partition_name(name, shard, num_shards):
+    """Table name for this shard's partition, e.g. msgs_trans_es_full_shard0of4."""
+    if num_shards == 1:
+        return name
+    return '{}_shard{}of{}'.format(name, shard, num_shards)
+
+
+def partition_path(path, shard, num_shards):
+    """File path for this shard's partition, e.g. wiki-translated-es-full.shard0of4.csv."""
+    if num_shards == 1:
+        return path
+    base, ext = os.path.splitext(path)
+    return '{}.shard{}of{}{}'.format(base, shard, num_shards, ext)
+
+
+def merge_tables(table, key, num_shards, con):
+    """Validates each shard's partition table and combines them into `table`, dropping the partitions.
+
+    Raises:
+        ValueError: If a partition holds keys belonging to another shard, e.g. because
+            it was written with a different --num-shards.
+    """
+    partitions = [partition_name(table, shard, num_shards) for shard in range(num_shards)]
+    with con.connect() as connection:
+        for shard, partition in enumerate(partitions):
+            keys = pd.read_sql('SELECT DISTINCT {} FROM {}'.format(key, partition), connection)[key]
+            misplaced = [k for k in keys if shard_of(k, num_shards) != shard]
+            if misplaced:
+                raise ValueError('{} has {} keys that belong to other shards, e.g. {}'.format(partition, len(misplaced), misplaced[0]))
+            print('{}: {} keys'.format(partition, len(keys)), file=sys.stderr)
+
+        union = ' UNION ALL '.join('SELECT * FROM {}'.format(partition) for partition in partitions)
+        connection.execute(text('DROP TABLE IF EXISTS {}'.format(table)))
+        connection.execute(text('CREATE TABLE {} AS {}'.format(table, union)))
+        for partition in partitions:
+            connection.execute(text('DROP TABLE {}'.format(partition)))
+
+
+def _raise_csv_field_limit():
+    # Cells hold whole cleaned pages, which can be far bigger than csv's 128 KB default
+    limit = sys.maxsize
+    while True:
+        try:
+            csv.field_size_limit(limit)
+            return
+        except OverflowError:  # e.g. where a C long is 32 bits
+            limit //= 2
+
+
+def merge_csvs(out_file, key, shard_files, header=False):
+    """Validates each shard's CSV and concatenates them into `out_file`.
+
+    Args:
+        out_file (str): File to write the merged CSV to.
+        key (str): Index of the column the shards were partitioned on, or its name if `header` is set.
+        shard_files (list): CSV written by each shard, in shard order.
+        header (bool): Whether each CSV starts with a header row. The first is written once.
+
+    Raises:
+        ValueError: If a row is in the wrong shard's file, or the headers differ.
+    """
+    _raise_csv_field_limit()
+    num_shards = len(shard_files)
+    first_header = None
+    key_index = int(key) if key.isdigit() else None
+    if key_index is None and not header:
+        raise ValueError('key must be a column index unless the CSVs have a header, got {}'.format(key))
+    with open(out_file, 'w', newline='') as out:
+        csvout = csv.writer(out)
+        for shard, shard_file in enumerate(shard_files):
+            n_rows = 0
+            with open(shard_file, newline='') as f:
+                rows = csv.reader(f)
+                if header:
+                    this_header = next(rows)
+                    if first_header is None:
+                        first_header = this_header
+                        csvout.writerow(first_header)
+                        if key_index is None:
+                            key_index = first_header.index(key)
+                    elif this_header != first_header:
+                        raise ValueError('{} has header {}, but {} has {}'.format(shard_file, this_header, shard_files[0], first_header))
+                for row in rows:
+                    if shard_of(row[key_index], num_shards) != shard:
+                        raise ValueError('{} has a row for key {}, which belongs to another shard'.format(shard_file, row[key_index]))
+                    csvout.writerow(row)
+                    n_rows += 1
+            print('{}: {} rows'.format(shard_file, n_rows), file=sys.stderr)
+
+
+def main():
+    args = parse_args()
+    if args.command == 'merge-tables':
+        merge_tables(args.table, args.key, args.num_shards, db_connect(args.db))
+    else:
+        merge_csvs(args.out_file, args.key, args.shard_files, args.header)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,14 +3,15 @@ import warnings
 
 import pandas as pd
 from nltk.tokenize import word_tokenize
-from pandarallel import pandarallel
 from sqlalchemy import create_engine
 from sqlalchemy.dialects.mysql import LONGTEXT
 from sqlalchemy.types import CHAR, INTEGER, VARCHAR
 from tqdm import tqdm
 
+import metrics
+from parallel import parallel_map
+
 warnings.filterwarnings('ignore')
-pandarallel.initialize(nb_workers=12, progress_bar=True)
 
 
 def parse_args():
@@ -18,6 +19,7 @@ def parse_args():
 	opts.add_argument('db')
 	opts.add_argument('trunc_tbl', help='Name of the table to be created with truncated English texts')
 	opts.add_argument('tbls', nargs='+', help='The names of the tables in each language, which contain English translations.')
+	metrics.add_args(opts)
 	args = opts.parse_args()
 	return args
 
@@ -29,10 +31,11 @@ def db_connect(db):
 
 def tokenized_pages(tbl, con):
 	df = pd.read_sql(tbl, con)
+	metrics.count('rows_read', len(df))
 	message_col = 'message_en'
 	if message_col not in df.columns:  # it's the English table, so hasn't been translated
 		message_col = 'message'
-	df['tokenized'] = df.parallel_apply(lambda r: list(word_tokenize(r[message_col])), axis=1)
+	df['tokenized'] = parallel_map(word_tokenize, df[message_col], n_jobs=12, desc=tbl)
 	df['length'] = df['tokenized'].apply(len)
 	return df
 
@@ -50,21 +53,27 @@ def unify_length(unified_id, full_tokenized):
 
 def main():
 	args = parse_args()
+	metrics.configure(args.metrics, args.profile)
 	con = db_connect(args.db)
 
 	# Tokenize all the English pages
-	msgs = pd.concat([tokenized_pages(tbl, con) for tbl in tqdm(args.tbls, desc='Tokenizing')])
-
-	pages = msgs['unified_id'].drop_duplicates().to_numpy()
-	truncated_df = pd.concat([unify_length(page, msgs) for page in tqdm(pages, desc='Unifying page lengths')])
-
-	truncated_df.to_sql(args.trunc_tbl, con, index=False, if_exists='replace', chunksize=500, dtype={
-			'unified_id': INTEGER,
-			'message_wiki_id': INTEGER,
-			'message': LONGTEXT,
-			'lang': CHAR(2),
-			'message_id': VARCHAR(126)
-		})
+	with metrics.stage('tokenize'):
+		msgs = pd.concat([tokenized_pages(tbl, con) for tbl in tqdm(args.tbls, desc='Tokenizing')])
+		metrics.count('tokens', int(msgs['length'].sum()))
+
+	with metrics.stage('unify_lengths'):
+		pages = msgs['unified_id'].drop_duplicates().to_numpy()
+		truncated_df = pd.concat([unify_length(page, msgs) for page in tqdm(pages, desc='Unifying page lengths')])
+
+	with metrics.stage('write_db'):
+		truncated_df.to_sql(args.trunc_tbl, con, index=False, if_exists='replace', chunksize=500, dtype={
+				'unified_id': INTEGER,
+				'message_wiki_id': INTEGER,
+				'message': LONGTEXT,
+				'lang': CHAR(2),
+				'message_id': VARCHAR(126)
+			})
+		metrics.count('rows_written', len(truncated_df))
 
 
 if __name__ == '__main__':
@@ -1,21 +1,28 @@
 import argparse
+import html
+import mmap
 import re
+from functools import partial
 from xml.etree import ElementTree as ET
 
 import mwparserfromhell as mwp
 import pandas as pd
-from pandarallel import pandarallel
 from sqlalchemy import create_engine
 from sqlalchemy.dialects.mysql import LONGTEXT
 from sqlalchemy.types import CHAR, INTEGER, VARCHAR
 from tqdm import tqdm
 
-pandarallel.initialize(nb_workers=5, progress_bar=True)
+import metrics
+import shard
+from parallel import parallel_map
 
 USER_DASHES_REGEX = r'(?:--|—)(?P<name>[^\s].+)$'
 DATE_REGEX_ES = r'(?:^|\.|\?|!|--|—)(?P<name>(?:[^\.]{1,60}?|[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3})(?: \([^)]+\))? )[0-9]{2}:[0-9]{2} [0-9]{1,2} [a-z]{3},? [0-9]{4} \([A-Z]{3,4}\)'
 DATE_REGEX_ZH_JA = r'(?:^|\.|。|？|！|--|—)(?P<name>(?:[^\.。]{1,60}?|[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3})(?: \([^)]+\))? ?)[0-9]{4} ?年 ?[0-9]{1,2} ?月 ?[0-9]{1,2} ?日 ?(?:[^0-9\.-;:,?!]+)?[0-9]{1,2}:[0-9]{1,2} ?[(（][^0-9\.()-;:,?!。]{3,4}[)）]'
 DATE_REGEX_EN = r'(?:^|\.|\?|!|--|—)(?P<name>(?:[^.]{1,60}?|(Preceding unsigned comment added by )?[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3})(?: \([^)]+\))? )[0-9]{1,2}:[0-9]{1,2},? ?[0-9]{1,2} ? [A-Za-z]+ [0-9]{4} \([A-Z]{3,4}\)'
+TITLE_TAG_REGEX = re.compile(rb'<title>(.*?)</title>', re.DOTALL)
+ID_TAG_REGEX = re.compile(rb'<id>([0-9]+)</id>')
+TEXT_TAG_REGEX = re.compile(rb'<text\b[^>]*?(/?)>')
 DATE_REGEX = {
     'es': DATE_REGEX_ES,
     'zh': DATE_REGEX_ZH_JA,
@@ -29,6 +36,9 @@ def parse_args():
     opts.add_argument('lang', choices=['es', 'zh', 'ja', 'en'])
     opts.add_argument('database')
     opts.add_argument('table')
+    opts.add_argument('--mmap', action='store_true', help='Send workers byte offsets into the memory-mapped match file instead of the page text')
+    metrics.add_args(opts)
+    shard.add_args(opts)
     args = opts.parse_args()
     return args
 
@@ -97,63 +107,171 @@ def subsections(page):
 
 
 def split_message_to_turns(msg, lang):
+    """Splits a page's wikitext into (user, turn) tuples.
+
+    Returns:
+        tuple: The list of turns and the number of signature regex matches found, which
+            is returned so the parent process can count it.
+    """
     page = mwp.parse(msg)
 
     turns = []
+    n_re_matches = 0
     
     # Get users iteratively over subsections.
     # Use subsections because they give us clues about where people are likely to sign off.
     for subsection in subsections(page):
         subsection = mwp.parse(subsection).strip_code()
         re_matches = find_users_by_regex(subsection, lang)
+        n_re_matches += len(re_matches)
         final_match = find_users_by_final_paragraph_signoff(subsection) if lang == 'es' or lang == 'en' else None
         turns += _split_message_to_turns(subsection, re_matches, final_match)
 
-    return turns
+    return turns, n_re_matches
 
 
 def pages(pages_file):
-    root = ET.parse(pages_file)
-    for page in root.iterfind('page'):
-        yield page
+    """Yields each page element as soon as it is parsed; callers clear pages they are done with."""
+    for _, elem in ET.iterparse(pages_file):
+        if elem.tag == 'page':
+            yield elem
+
+
+def text_ranges(pages_file):
+    """Scans the match file for the byte range of each page's text, without parsing the text itself.
+
+    Args:
+        pages_file (str): Output of link.py
+
+    Yields:
+        tuple: (title, message_wiki_id, text_offset, text_length), where the offset and length are in bytes.
+    """
+    with open(pages_file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        start = mapped.find(b'<page>')
+        while start != -1:
+            end = mapped.find(b'</page>', start)
+            title = TITLE_TAG_REGEX.search(mapped, start, end).group(1).decode('utf8')
+            wiki_id = ID_TAG_REGEX.search(mapped, start, end).group(1).decode('utf8')
+            text_tag = TEXT_TAG_REGEX.search(mapped, start, end)
+            if text_tag.group(1):  # self-closing, i.e. empty, <text/>
+                offset, length = text_tag.end(), 0
+            else:
+                offset = text_tag.end()
+                length = mapped.find(b'</text>', offset, end) - offset
+            yield html.unescape(title), wiki_id, offset, length
+            start = mapped.find(b'<page>', end)
+
+
+_mapped_files = {}
+
+
+def split_range_to_turns(text_range, pages_file, lang):
+    """Splits one page into turns, reading its text straight from the memory-mapped match file.
+
+    Each worker maps the file once and decodes only the slice it was handed, so the
+    parent only ever sends (offset, length) pairs.
+
+    Args:
+        text_range (tuple): (text_offset, text_length) from `text_ranges`.
+        pages_file (str): Output of link.py
+        lang (str): Language of the pages.
+    """
+    if pages_file not in _mapped_files:
+        with open(pages_file, 'rb') as f:
+            _mapped_files[pages_file] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    offset, length = text_range
+    with memoryview(_mapped_files[pages_file])[offset:offset + length] as raw:
+        msg = html.unescape(str(raw, 'utf8'))
+    return split_message_to_turns(msg, lang)
+
+
+def _add_turns(df, results):
+    """Stores the results of `split_message_to_turns` in `df` and counts them."""
+    df['turns'] = [turns for turns, _ in results]
+    metrics.count('regex_matches', sum(n_re_matches for _, n_re_matches in results))
+    metrics.count('turns', sum(len(turns) for turns, _ in results))
+
+
+def split_pages_in_memory(pages_file, lang, shard_index=0, num_shards=1):
+    """Parses every page into a DataFrame and sends each page's text to the workers.
+
+    Returns:
+        pd.DataFrame: One row per page with its title, message_wiki_id and list of turns.
+    """
+    # Accumulate all pages so we can split them in parallel later
+    with metrics.stage('parse_xml'):
+        df = pd.DataFrame(columns=['title', 'message_wiki_id', 'message'])
+        i = 0
+        for page in tqdm(pages(pages_file)):
+            i += 1
+            #if page.find('title').text != 'Discusión:Astrología':
+            #if page.find('title').text != 'Talk:生物学':
+            #if page.find('title').text != 'Talk:Algeria':
+                #continue
+            title =  page.find('title').text
+            msg_wiki_id = page.find('id').text
+            if shard.in_shard(msg_wiki_id, shard_index, num_shards):
+                content = page.find('revision').find('text').text
+                metrics.count('pages_parsed')
+                df = pd.concat([df, pd.DataFrame.from_records([(title, msg_wiki_id, content)], columns=['title', 'message_wiki_id', 'message'])])
+            page.clear()  # its text is in df now, or belongs to another shard
+
+    with metrics.stage('split_turns'):
+        results = parallel_map(partial(split_message_to_turns, lang=lang), df['message'], cost=lambda msg: len(msg or ''), n_jobs=5, desc='Splitting turns')
+        _add_turns(df, results)
+    return df.drop('message', axis=1)
+
+
+def split_pages_mmap(pages_file, lang, shard_index=0, num_shards=1):
+    """Like `split_pages_in_memory`, but only sends workers the byte range of each page's text.
+
+    Returns:
+        pd.DataFrame: One row per page with its title, message_wiki_id and list of turns.
+    """
+    # Only collect where each page's text lives; workers read it themselves
+    with metrics.stage('scan_xml'):
+        df = pd.DataFrame.from_records(text_ranges(pages_file), columns=['title', 'message_wiki_id', 'text_offset', 'text_length'])
+        df = shard.select(df, 'message_wiki_id', shard_index, num_shards)
+        metrics.count('pages_parsed', len(df))
+
+    with metrics.stage('split_turns'):
+        ranges = list(zip(df['text_offset'].tolist(), df['text_length'].tolist()))
+        split = partial(split_range_to_turns, pages_file=pages_file, lang=lang)
+        results = parallel_map(split, ranges, cost=lambda text_range: text_range[1], n_jobs=5, desc='Splitting turns')
+        _add_turns(df, results)
+    return df.drop(['text_offset', 'text_length'], axis=1)
 
 
 def main():
     args = parse_args()
+    metrics.configure(args.metrics, args.profile)
+    shard.check_shard(args.shard, args.num_shards)
 
-    # Accumulate all pages so we can split them in parallel later
-    df = pd.DataFrame()
-    i = 0
-    for page in tqdm(pages(args.match_file)):
-        i += 1
-        #if page.find('title').text != 'Discusión:Astrología':
-        #if page.find('title').text != 'Talk:生物学':
-        #if page.find('title').text != 'Talk:Algeria':
-            #continue
-        title =  page.find('title').text
-        msg_wiki_id = page.find('id').text
-        content = page.find('revision').find('text').text
-        df = pd.concat([df, pd.DataFrame.from_records([(title, msg_wiki_id, content)], columns=['title', 'message_wiki_id', 'message'])])
-
-    # Split pages into turns and get DataFrame in shape
-    df['turns'] = df['message'].parallel_apply(lambda msg: split_message_to_turns(msg, args.lang)).apply(list)
+    if args.mmap:
+        df = split_pages_mmap(args.match_file, args.lang, args.shard, args.num_shards)
+    else:
+        df = split_pages_in_memory(args.match_file, args.lang, args.shard, args.num_shards)
+
+    # Get DataFrame of turns in shape
     df = df.explode('turns')
-    df[['user', 'turn']] = pd.DataFrame(df['turns'].tolist(), index=df.index)
+    df[['user', 'turn']] = pd.DataFrame(df['turns'].tolist(), index=df.index, columns=['user', 'turn'])
     df['user'] = df['user'].str.slice(-127)
-    df.drop(['turns', 'message'], axis=1, inplace=True)
+    df.drop('turns', axis=1, inplace=True)
     df['turn_num'] = df.groupby('title').cumcount() + 1
     
     # Write to database
     eng = db_connect(args.database)
-    df.to_sql(args.table, eng, if_exists='replace', index=False, chunksize=5000, dtype={
-			'unified_id': INTEGER,
-			'message_wiki_id': INTEGER,
-            'turn': LONGTEXT,
-            'user': VARCHAR(127),
-            'datetime': VARCHAR(127),
-			'lang': CHAR(2),
-			'message_id': VARCHAR(126)
-		})
+    with metrics.stage('write_db'):
+        df.to_sql(shard.partition_name(args.table, args.shard, args.num_shards), eng, if_exists='replace', index=False, chunksize=5000, dtype={
+                'unified_id': INTEGER,
+                'message_wiki_id': INTEGER,
+                'turn': LONGTEXT,
+                'user': VARCHAR(127),
+                'datetime': VARCHAR(127),
+                'lang': CHAR(2),
+                'message_id': VARCHAR(126)
+            })
+        metrics.count('rows_written', len(df))
 
 
 if __name__ == '__main__':
@@ -0,0 +1 @@
+../talk-pages/metrics.py
\ No newline at end of file
@@ -0,0 +1 @@
+../talk-pages/shard.py
\ No newline at end of file
@@ -5,9 +5,12 @@ from googletrans import Translator
 from sqlalchemy import create_engine
 from sqlalchemy.dialects.mysql import LONGTEXT
 from sqlalchemy.types import CHAR, INTEGER, VARCHAR
-from time import sleep
+from time import sleep, time
 from tqdm import tqdm
 
+import metrics
+import shard
+
 
 tqdm.pandas()
 
@@ -17,6 +20,8 @@ def parse_args():
     opts.add_argument('db')
     opts.add_argument('lang')
     opts.add_argument('--table', default='msgs')
+    metrics.add_args(opts)
+    shard.add_args(opts)
     args = opts.parse_args()
     return args
 
@@ -27,11 +32,12 @@ def db_connect(db):
     return con
 
 
-def documents(table, lang, con):
+def documents(table, lang, con, shard_index=0, num_shards=1):
     sql = """SELECT *
              FROM {tbl} t 
-             WHERE lang = '{lang}'"""
-    sql = sql.format(tbl=table, lang=lang)
+             WHERE lang = '{lang}'
+             AND {in_shard}"""
+    sql = sql.format(tbl=table, lang=lang, in_shard=shard.sql_condition('unified_id', shard_index, num_shards))
     df = pd.read_sql(sql, con)
     return df
 
@@ -48,9 +54,13 @@ def translate(doc, chunk_size=3000, attempt=0):
         sleep(3)
         t = Translator()
         try:
+            metrics.count('translation_requests')
+            start = time()
             res = t.translate(doc_piece)
+            metrics.count('translation_seconds', time() - start)
             translated += ' ' + res.text
         except:
+            metrics.count('translation_errors')
             seconds_to_wait = attempt * 10
             print('Error translating, will try again in {} seconds...'.format(seconds_to_wait))
             sleep(seconds_to_wait - 3)
@@ -65,26 +75,33 @@ def translate_docs(df):
 
 def main():
     args = parse_args()
+    metrics.configure(args.metrics, args.profile)
+    shard.check_shard(args.shard, args.num_shards)
     con = db_connect(args.db)
 
-    docs = documents(args.table, args.lang, con)
-    translated = translate_docs(docs)
+    with metrics.stage('read_db'):
+        docs = documents(args.table, args.lang, con, args.shard, args.num_shards)
+    with metrics.stage('translate'):
+        translated = translate_docs(docs)
 
     # Get a fresh connection to avoid "MySQL server has gone away" error
     con = db_connect(args.db)
 
-    translated.to_csv(
-        '/sandata/garrick/wikipedia/wiki-translated-{}-full.csv'.format(args.lang))
-    translated.to_sql('{}_trans_{}_full'.format(args.table, args.lang), con,
-		if_exists='replace', index=False, chunksize=500, dtype={
-			'unified_id': INTEGER,
-			'message_wiki_id': INTEGER,
-			'message_en': LONGTEXT,
-			'message': LONGTEXT,
-			'lang': CHAR(2),
-			'message_id': VARCHAR(126)
-		}
-	)
+    with metrics.stage('write_db'):
+        translated.to_csv(
+            shard.partition_path('/sandata/garrick/wikipedia/wiki-translated-{}-full.csv'.format(args.lang), args.shard, args.num_shards),
+            index=args.num_shards == 1)  # partitions have no index column, so merge-csvs sees only table columns
+        translated.to_sql(shard.partition_name('{}_trans_{}_full'.format(args.table, args.lang), args.shard, args.num_shards), con,
+            if_exists='replace', index=False, chunksize=500, dtype={
+                'unified_id': INTEGER,
+                'message_wiki_id': INTEGER,
+                'message_en': LONGTEXT,
+                'message': LONGTEXT,
+                'lang': CHAR(2),
+                'message_id': VARCHAR(126)
+            }
+        )
+        metrics.count('rows_written', len(translated))
 
 
 if __name__ == '__main__':
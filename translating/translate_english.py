@@ -5,9 +5,12 @@ from googletrans import Translator
 from sqlalchemy import create_engine
 from sqlalchemy.dialects.mysql import LONGTEXT
 from sqlalchemy.types import CHAR, INTEGER, VARCHAR
-from time import sleep
+from time import sleep, time
 from tqdm import tqdm
 
+import metrics
+import shard
+
 
 tqdm.pandas()
 
@@ -17,6 +20,8 @@ def parse_args():
     opts.add_argument('db')
     opts.add_argument('--langs', nargs='+', default=['es', 'ja', 'zh'])
     opts.add_argument('--table', default='msgs')
+    metrics.add_args(opts)
+    shard.add_args(opts)
     args = opts.parse_args()
     return args
 
@@ -27,11 +32,12 @@ def db_connect(db):
     return con
 
 
-def documents(table, con):
+def documents(table, con, shard_index=0, num_shards=1):
     sql = """SELECT *
              FROM {tbl} t 
-             WHERE lang = 'en'"""
-    sql = sql.format(tbl=table)
+             WHERE lang = 'en'
+             AND {in_shard}"""
+    sql = sql.format(tbl=table, in_shard=shard.sql_condition('unified_id', shard_index, num_shards))
     df = pd.read_sql(sql, con)
     return df
 
@@ -48,9 +54,13 @@ def translate(doc, lang, chunk_size=3000, attempt=0):
         sleep(2)
         t = Translator()
         try:
+            metrics.count('translation_requests')
+            start = time()
             res = t.translate(doc_piece, src='en', dest=lang)
+            metrics.count('translation_seconds', time() - start)
             translated += ' ' + res.text
         except:
+            metrics.count('translation_errors')
             seconds_to_wait = attempt * 10
             print('Error translating, will try again in {} seconds...'.format(seconds_to_wait))
             sleep(seconds_to_wait - 2)
@@ -67,10 +77,14 @@ def translate_docs(df, *langs):
 
 def main():
     args = parse_args()
+    metrics.configure(args.metrics, args.profile)
+    shard.check_shard(args.shard, args.num_shards)
     con = db_connect(args.db)
 
-    docs = documents(args.table, con)
-    translated = translate_docs(docs, *args.langs)
+    with metrics.stage('read_db'):
+        docs = documents(args.table, con, args.shard, args.num_shards)
+    with metrics.stage('translate'):
+        translated = translate_docs(docs, *args.langs)
 
     # Get a fresh connection to avoid "MySQL server has gone away" error
     con = db_connect(args.db)
@@ -85,10 +99,13 @@ def main():
     for lang in args.langs:
         dtypes['message_{}'.format(lang)] = LONGTEXT
 
-    translated.to_csv(
-        '/sandata/garrick/wikipedia/wiki-translated-en-{}-full.csv'.format(args.langs[0]))
-    translated.to_sql('{}_trans_en_{}_full'.format(args.table, args.langs[0]), con,
-		if_exists='replace', index=False, chunksize=1000, dtype=dtypes)
+    with metrics.stage('write_db'):
+        translated.to_csv(
+            shard.partition_path('/sandata/garrick/wikipedia/wiki-translated-en-{}-full.csv'.format(args.langs[0]), args.shard, args.num_shards),
+            index=args.num_shards == 1)  # partitions have no index column, so merge-csvs sees only table columns
+        translated.to_sql(shard.partition_name('{}_trans_en_{}_full'.format(args.table, args.langs[0]), args.shard, args.num_shards), con,
+            if_exists='replace', index=False, chunksize=1000, dtype=dtypes)
+        metrics.count('rows_written', len(translated))
 
 
 if __name__ == '__main__':